@@ -3,9 +3,15 @@ from fastapi.responses import HTMLResponse
 import uvicorn
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy import text
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator, model_validator
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import math
 import os
+import time
 
 # 設定 FastAPI 應用程式
 app = FastAPI()
@@ -19,12 +25,102 @@ port = "5432"
 engine = create_async_engine(f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{database}", echo=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
 
+# 查詢成本上限設定 超過上限的請求直接拒絕
+MAX_RADIUS = float(os.getenv("MAX_RADIUS", 20000))  # 半徑上限(公尺)
+MAX_POLYGON_VERTICES = int(os.getenv("MAX_POLYGON_VERTICES", 10000))  # 多邊形頂點數上限
+MAX_WKT_LENGTH = int(os.getenv("MAX_WKT_LENGTH", MAX_POLYGON_VERTICES * 48))  # WKT字串長度上限(每個頂點約48字元)
+
+# 高成本查詢判定門檻 超過任一門檻即改走高成本通道
+EXPENSIVE_AREA = float(os.getenv("EXPENSIVE_AREA", 2e7))  # 查詢面積(平方公尺)
+EXPENSIVE_VERTICES = int(os.getenv("EXPENSIVE_VERTICES", 1000))  # 多邊形頂點數
+EXPENSIVE_ROWS = {  # 各資料表預估候選筆數(密度網格為預估回傳網格數)
+    "households": int(os.getenv("EXPENSIVE_HOUSEHOLDS_ROWS", 50000)),
+    "population": int(os.getenv("EXPENSIVE_POPULATION_ROWS", 2000)),
+    "density_grid": int(os.getenv("EXPENSIVE_GRID_CELLS", 5000)),
+}
+
+
+# 查詢通道: 限制同時執行數量、排隊數量與SQL執行時間上限
+class QueryLane:
+
+    def __init__(self, name, concurrency, queue_size, queue_timeout, statement_timeout):
+        self.name = name
+        self.queue_size = queue_size  # 最大排隊數量
+        self.queue_timeout = queue_timeout  # 排隊等待上限(秒)
+        self.statement_timeout = statement_timeout  # SQL執行時間上限(毫秒)
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    # 取得執行名額 排隊已滿回傳429 等待逾時回傳503
+    @asynccontextmanager
+    async def slot(self):
+        retry_after = {"Retry-After": str(math.ceil(self.queue_timeout))}
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            raise HTTPException(status_code=429, detail=f"Too many {self.name} queries queued, please retry later", headers=retry_after)
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail=f"Timed out waiting for a {self.name} query slot", headers=retry_after)
+        finally:
+            self.waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+# 一般查詢通道 保留給互動式的小範圍查詢
+cheap_lane = QueryLane(
+    "cheap",
+    concurrency=int(os.getenv("CHEAP_LANE_CONCURRENCY", 8)),
+    queue_size=int(os.getenv("CHEAP_LANE_QUEUE_SIZE", 64)),
+    queue_timeout=float(os.getenv("CHEAP_LANE_QUEUE_TIMEOUT", 5)),
+    statement_timeout=int(os.getenv("CHEAP_LANE_STATEMENT_TIMEOUT", 3000)),
+)
+
+# 高成本查詢通道 大半徑、大範圍或複雜多邊形在此排隊 避免拖慢一般查詢
+expensive_lane = QueryLane(
+    "expensive",
+    concurrency=int(os.getenv("EXPENSIVE_LANE_CONCURRENCY", 2)),
+    queue_size=int(os.getenv("EXPENSIVE_LANE_QUEUE_SIZE", 8)),
+    queue_timeout=float(os.getenv("EXPENSIVE_LANE_QUEUE_TIMEOUT", 30)),
+    statement_timeout=int(os.getenv("EXPENSIVE_LANE_STATEMENT_TIMEOUT", 30000)),
+)
+
+# 成本估算通道 估算本身也需連線資料庫 以少量名額與短時間上限避免在分流前佔滿連線
+estimate_lane = QueryLane(
+    "estimate",
+    concurrency=int(os.getenv("ESTIMATE_LANE_CONCURRENCY", 4)),
+    queue_size=int(os.getenv("ESTIMATE_LANE_QUEUE_SIZE", 64)),
+    queue_timeout=float(os.getenv("ESTIMATE_LANE_QUEUE_TIMEOUT", 5)),
+    statement_timeout=int(os.getenv("ESTIMATE_LANE_STATEMENT_TIMEOUT", 500)),
+)
+
+# 最近鄰查詢單次回傳筆數上限
+MAX_NEAREST_LIMIT = int(os.getenv("MAX_NEAREST_LIMIT", 5000))
+
+# 未指定資料年度(民國年)時使用的預設年度
+DEFAULT_VINTAGE = int(os.getenv("DEFAULT_VINTAGE", 112))
+
+# 遇到未知年度時重新讀取已匯入年度清單的最短間隔(秒)
+VINTAGE_REFRESH_INTERVAL = float(os.getenv("VINTAGE_REFRESH_INTERVAL", 10))
+
+# 預先計算的密度網格解析度(六角形邊長 單位為公尺) 需與資料匯入程式一致
+DENSITY_GRID_RESOLUTIONS = [250, 500, 1000, 2000, 4000]
+
+# 密度網格單次回傳網格數上限
+MAX_GRID_CELLS = int(os.getenv("MAX_GRID_CELLS", 20000))
+
 # 請求單點模型
 class PointRequest(BaseModel):
-    longitude: float  # 經度
-    latitude: float  # 緯度
-    radius: float  # 單位為公尺
+    longitude: float = Field(ge=-180, le=180)  # 經度
+    latitude: float = Field(ge=-90, le=90)  # 緯度
+    radius: float = Field(gt=0, le=MAX_RADIUS)  # 單位為公尺
     overlap_ratio: float = Query(0.8, ge=0, le=1)  # 重疊面積比率門檻 超過此門檻才會被納入計算 預設為80%
+    vintage: int = DEFAULT_VINTAGE  # 資料年度(民國年)
 
     model_config = {
         "json_schema_extra": {
@@ -33,7 +129,8 @@ class PointRequest(BaseModel):
                     "longitude": 120.1854,
                     "latitude": 22.9921,
                     "radius": 500,
-                    "overlap_ratio": 0.8
+                    "overlap_ratio": 0.8,
+                    "vintage": 112
                 }
             ]
         }
@@ -41,20 +138,96 @@ class PointRequest(BaseModel):
 
 # 請求多邊範圍模型
 class PolygonRequest(BaseModel):
-    wkt_polygon: str  # Well-Known Text 格式的多邊形 例如: POLYGON((x1 y1, x2 y2, x3 y3, x1 y1))
+    wkt_polygon: str = Field(max_length=MAX_WKT_LENGTH)  # Well-Known Text 格式的多邊形 例如: POLYGON((x1 y1, x2 y2, x3 y3, x1 y1))
     overlap_ratio: float = Query(0.8, ge=0, le=1)  # 重疊面積比率門檻 超過此門檻才會被納入計算 預設為80%
+    vintage: int = DEFAULT_VINTAGE  # 資料年度(民國年)
+
+    # 送入資料庫解析前先以座標分隔符號估算頂點數 超過上限直接拒絕
+    @field_validator("wkt_polygon")
+    @classmethod
+    def check_vertices(cls, value):
+        vertices = value.count(",") + 1
+        if vertices > MAX_POLYGON_VERTICES:
+            raise ValueError(f"Polygon has {vertices} vertices, the limit is {MAX_POLYGON_VERTICES}")
+        return value
 
     model_config = {
         "json_schema_extra": {
             "examples": [
                 {
                     "wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))",
-                    "overlap_ratio": 0.8
+                    "overlap_ratio": 0.8,
+                    "vintage": 112
+                }
+            ]
+        }
+    }
+
+# 請求最近鄰查詢模型
+class NearestRequest(BaseModel):
+    longitude: float = Field(ge=-180, le=180)  # 經度
+    latitude: float = Field(ge=-90, le=90)  # 緯度
+    limit: int = Field(10, ge=1, le=MAX_NEAREST_LIMIT)  # 回傳最近的筆數
+    vintage: int = DEFAULT_VINTAGE  # 資料年度(民國年)
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "longitude": 120.1854,
+                    "latitude": 22.9921,
+                    "limit": 10,
+                    "vintage": 112
+                }
+            ]
+        }
+    }
+
+# 請求密度網格模型
+class GridRequest(BaseModel):
+    min_longitude: float = Field(ge=-180, le=180)  # 範圍框最小經度
+    min_latitude: float = Field(ge=-90, le=90)  # 範圍框最小緯度
+    max_longitude: float = Field(ge=-180, le=180)  # 範圍框最大經度
+    max_latitude: float = Field(ge=-90, le=90)  # 範圍框最大緯度
+    resolution: int = 1000  # 網格解析度(六角形邊長 單位為公尺)
+    vintage: int = DEFAULT_VINTAGE  # 資料年度(民國年)
+
+    # 範圍框最小值需小於最大值
+    @model_validator(mode="after")
+    def check_bbox(self):
+        if self.min_longitude >= self.max_longitude or self.min_latitude >= self.max_latitude:
+            raise ValueError("min_longitude/min_latitude must be less than max_longitude/max_latitude")
+        return self
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "min_longitude": 120.15,
+                    "min_latitude": 22.95,
+                    "max_longitude": 120.25,
+                    "max_latitude": 23.05,
+                    "resolution": 500,
+                    "vintage": 112
                 }
             ]
         }
     }
 
+# 查詢成本估算模型
+class QueryCost(BaseModel):
+    area: float  # 查詢面積(平方公尺)
+    vertices: int  # 查詢範圍頂點數
+    rows: float = 0  # 資料庫規劃器預估的候選筆數
+
+    # 判斷是否為高成本查詢 未查詢資料表(只計算面積)時成本只與頂點數有關
+    def is_expensive(self, table=None):
+        if self.vertices > EXPENSIVE_VERTICES:
+            return True
+        if table is None:
+            return False
+        return self.area > EXPENSIVE_AREA or self.rows > EXPENSIVE_ROWS[table]
+
 # 回傳家戶數模型
 class HouseholdsResponse(BaseModel):
     households: int  # 家戶數量
@@ -67,6 +240,159 @@ class PopulationResponse(BaseModel):
 class AreaResponse(BaseModel):
     area: float  # 面積(平方米)
 
+# 最近門牌資料模型
+class NearestHousehold(BaseModel):
+    city_code: str | None = None  # 縣市代碼
+    dist_code: str | None = None  # 鄉鎮市區代碼
+    village: str | None = None  # 村里
+    neighborhood: str | None = None  # 鄰
+    road_street: str | None = None  # 街路段
+    area: str | None = None  # 地區
+    lane: str | None = None  # 巷
+    alley: str | None = None  # 弄
+    number: str | None = None  # 號
+    longitude: float  # 經度
+    latitude: float  # 緯度
+    distance: float  # 與指定點距離(公尺)
+
+# 回傳最近門牌模型
+class NearestHouseholdsResponse(BaseModel):
+    households: list[NearestHousehold]  # 依距離由近到遠排序
+
+# 最近有人口統計區資料模型
+class NearestBlock(BaseModel):
+    population: int  # 人口數量
+    properties: dict  # 統計區其餘屬性(統計區代碼、鄉鎮市區等)
+    distance: float  # 與指定點距離(公尺) 位於統計區內為0
+
+# 回傳最近有人口統計區模型
+class NearestPopulationResponse(BaseModel):
+    blocks: list[NearestBlock]  # 依距離由近到遠排序
+
+# 回傳密度網格模型(GeoJSON FeatureCollection)
+class GridResponse(BaseModel):
+    type: str = "FeatureCollection"
+    features: list[dict]  # 各網格的家戶數、人口數與每平方公里密度
+
+# 已匯入的資料年度快取 {資料表: {年度}}
+loaded_vintages = {}
+loaded_vintages_refreshed_at = 0.0
+
+
+# 確認指定資料表已匯入該年度 未匯入的年度回傳404 避免空分區被當成0筆的查詢結果
+async def check_vintage(table, vintage):
+    global loaded_vintages, loaded_vintages_refreshed_at
+    if vintage in loaded_vintages.get(table, ()):
+        return
+
+    if time.monotonic() - loaded_vintages_refreshed_at >= VINTAGE_REFRESH_INTERVAL:
+        async with lane_session(estimate_lane) as session:
+            result = await session.execute(text("SELECT table_name, vintage FROM dataset_vintages;"))
+            refreshed = {}
+            for row in result:
+                refreshed.setdefault(row.table_name, set()).add(row.vintage)
+        loaded_vintages = refreshed
+        loaded_vintages_refreshed_at = time.monotonic()
+        if vintage in loaded_vintages.get(table, ()):
+            return
+
+    raise HTTPException(status_code=404, detail=f"No {table} data loaded for vintage {vintage}")
+
+
+# 向資料庫規劃器取得範圍框內的預估候選筆數(只做規劃不實際查詢)
+async def estimate_candidate_rows(session, table, bbox, vintage):
+    xmin, ymin, xmax, ymax = bbox
+    query = text(f"""
+        EXPLAIN (FORMAT JSON)
+        SELECT 1 FROM {table}
+        WHERE vintage = :vintage
+          AND geometry && ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326);
+    """)
+    result = await session.execute(query, {"vintage": vintage, "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax})
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+# 估算單點半徑查詢成本
+async def estimate_point_cost(request, table=None):
+    cost = QueryCost(area=math.pi * request.radius ** 2, vertices=1)
+    if table is not None:
+        # 以半徑換算經緯度範圍框
+        dlat = request.radius / 111320
+        dlon = request.radius / (111320 * max(math.cos(math.radians(request.latitude)), 0.01))
+        bbox = (request.longitude - dlon, request.latitude - dlat, request.longitude + dlon, request.latitude + dlat)
+        async with lane_session(estimate_lane) as session:
+            cost.rows = await estimate_candidate_rows(session, table, bbox, request.vintage)
+    return cost
+
+
+# 估算多邊形範圍查詢成本
+async def estimate_polygon_cost(request, table=None):
+    async with lane_session(estimate_lane) as session:
+        query = text("""
+            WITH input_polygon AS (
+                SELECT ST_GeomFromText(:wkt_polygon, 4326) AS geom
+            )
+            SELECT ST_NPoints(geom) AS vertices, ST_Area(geography(geom)) AS area,
+                   ST_XMin(geom) AS xmin, ST_YMin(geom) AS ymin, ST_XMax(geom) AS xmax, ST_YMax(geom) AS ymax
+            FROM input_polygon;
+        """)
+        try:
+            result = await session.execute(query, {"wkt_polygon": request.wkt_polygon})
+        except DBAPIError as e:
+            if getattr(e.orig, "sqlstate", None) == "57014":
+                raise
+            raise HTTPException(status_code=400, detail=f"Invalid wkt_polygon: {e.orig}")
+        data = result.fetchone()
+        if data.vertices > MAX_POLYGON_VERTICES:
+            raise HTTPException(status_code=422, detail=f"Polygon has {data.vertices} vertices, the limit is {MAX_POLYGON_VERTICES}")
+
+        cost = QueryCost(area=data.area or 0, vertices=data.vertices)
+        if table is not None:
+            cost.rows = await estimate_candidate_rows(session, table, (data.xmin, data.ymin, data.xmax, data.ymax), request.vintage)
+    return cost
+
+
+# 估算密度網格查詢成本 以範圍框面積除以單一六角形面積估算回傳網格數
+def estimate_grid_cost(request):
+    mid_latitude = math.radians((request.min_latitude + request.max_latitude) / 2)
+    width = (request.max_longitude - request.min_longitude) * 111320 * math.cos(mid_latitude)
+    height = (request.max_latitude - request.min_latitude) * 111320
+    cells = width * height / (3 * math.sqrt(3) / 2 * request.resolution ** 2)
+    if cells > MAX_GRID_CELLS:
+        raise HTTPException(status_code=422, detail=f"About {cells:.0f} grid cells requested, the limit is {MAX_GRID_CELLS}; use a smaller bbox or a coarser resolution")
+    return QueryCost(area=0, vertices=4, rows=cells)
+
+
+# 依查詢成本分配一般或高成本通道
+def admitted_session(cost, table=None):
+    return lane_session(expensive_lane if cost.is_expensive(table) else cheap_lane)
+
+
+# 取得通道名額 並開啟套用該通道SQL執行時間上限的資料庫連線
+@asynccontextmanager
+async def lane_session(lane):
+    async with lane.slot():
+        async with SessionLocal() as session:
+            try:
+                await session.execute(
+                    text("SELECT set_config('statement_timeout', :timeout, true);"),
+                    {"timeout": str(lane.statement_timeout)},
+                )
+                yield session
+            except HTTPException:
+                raise
+            except DBAPIError as e:
+                # 57014: 超過SQL執行時間上限被取消
+                if getattr(e.orig, "sqlstate", None) == "57014":
+                    raise HTTPException(status_code=503, detail=f"Query exceeded the {lane.name} lane time limit", headers={"Retry-After": "60"})
+                raise HTTPException(status_code=500, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+
+
 # 首頁
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -78,184 +404,287 @@ async def index():
 # 計算單點半徑範圍內家戶數
 @app.post("/households/point", response_model=HouseholdsResponse)
 async def get_households_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""       
-                SELECT count(*) as households
-                FROM households
-                WHERE ST_DWithin(
-                    geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)),
-                    geography(geometry),
-                    :radius
-                );
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius
-            })
-            data = result.fetchone()
-
-            if data:
-                return HouseholdsResponse(households=data.households or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    await check_vintage("households", request.vintage)
+    cost = await estimate_point_cost(request, "households")
+    async with admitted_session(cost, "households") as session:
+        # 使用 PostGIS 查詢範圍內的戶數
+        query = text("""       
+            SELECT count(*) as households
+            FROM households
+            WHERE vintage = :vintage
+            AND ST_DWithin(
+                geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)),
+                geography(geometry),
+                :radius
+            );
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "longitude": request.longitude,
+            "latitude": request.latitude,
+            "radius": request.radius
+        })
+        data = result.fetchone()
+
+        if data:
+            return HouseholdsResponse(households=data.households or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified radius")
 
 
 # 計算單點半徑範圍內人口數
 @app.post("/population/point", response_model=PopulationResponse)
 async def get_population_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的人口數
-            query = text("""
-                WITH 
-                target_point AS (
-                    SELECT ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326) AS geom
-                ),
-                buffered_area AS (
-                    SELECT ST_Buffer(ST_Transform(geom, 3857), :radius) AS geom
-                    FROM target_point
-                )
-                SELECT sum(population.p_cnt) as population
-                FROM population
-                JOIN buffered_area ON ST_Intersects(ST_Transform(population.geometry, 3857), buffered_area.geom)
-                WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius,
-                "overlap_ratio": request.overlap_ratio,
-            })
-            data = result.fetchone()
-
-            if data:
-                return PopulationResponse(population=data.population or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    await check_vintage("population", request.vintage)
+    cost = await estimate_point_cost(request, "population")
+    async with admitted_session(cost, "population") as session:
+        # 使用 PostGIS 查詢範圍內的人口數 空間篩選直接比對原始geometry欄位才能使用空間索引
+        query = text("""
+            WITH 
+            target_point AS (
+                SELECT ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326) AS geom
+            ),
+            buffered_area AS (
+                SELECT ST_Buffer(ST_Transform(geom, 3857), :radius) AS geom
+                FROM target_point
+            )
+            SELECT sum(population.p_cnt) as population
+            FROM population
+            JOIN buffered_area ON ST_Intersects(population.geometry, ST_Transform(buffered_area.geom, 4326))
+            WHERE population.vintage = :vintage
+            AND (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "longitude": request.longitude,
+            "latitude": request.latitude,
+            "radius": request.radius,
+            "overlap_ratio": request.overlap_ratio,
+        })
+        data = result.fetchone()
+
+        if data:
+            return PopulationResponse(population=data.population or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified radius")
 
 
 # 計算單點半徑範圍內面積
 @app.post("/area/point", response_model=AreaResponse)
 async def get_area_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""       
-                SELECT ST_Area(
-                    ST_Buffer(
-                        ST_SetSRID(ST_Point(:longitude, :latitude), 4326)::geography, 
-                        :radius
-                    )
-                ) AS area;
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius
-            })
-            data = result.fetchone()
-
-            if data:
-                return AreaResponse(area=data.area or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    cost = await estimate_point_cost(request)
+    async with admitted_session(cost) as session:
+        # 使用 PostGIS 查詢範圍內的戶數
+        query = text("""       
+            SELECT ST_Area(
+                ST_Buffer(
+                    ST_SetSRID(ST_Point(:longitude, :latitude), 4326)::geography, 
+                    :radius
+                )
+            ) AS area;
+        """)
+        result = await session.execute(query, {
+            "longitude": request.longitude,
+            "latitude": request.latitude,
+            "radius": request.radius
+        })
+        data = result.fetchone()
+
+        if data:
+            return AreaResponse(area=data.area or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified radius")
         
 
 # 計算多點面積範圍內家戶數
 @app.post("/households/polygon", response_model=HouseholdsResponse)
 async def get_households_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""
-                SELECT count(*) as households
-                FROM households
-                WHERE ST_Within(
-                    geometry, 
-                    ST_GeomFromText(:wkt_polygon, 4326));
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-            })
-            data = result.fetchone()
-
-            if data:
-                return HouseholdsResponse(households=data.households or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    await check_vintage("households", request.vintage)
+    cost = await estimate_polygon_cost(request, "households")
+    async with admitted_session(cost, "households") as session:
+        # 使用 PostGIS 查詢範圍內的戶數
+        query = text("""
+            SELECT count(*) as households
+            FROM households
+            WHERE vintage = :vintage
+            AND ST_Within(
+                geometry, 
+                ST_GeomFromText(:wkt_polygon, 4326));
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "wkt_polygon": request.wkt_polygon,
+        })
+        data = result.fetchone()
+
+        if data:
+            return HouseholdsResponse(households=data.households or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
 
 
 # 計算多點面積範圍內人口數
 @app.post("/population/polygon", response_model=PopulationResponse)
 async def get_households_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的人口數
-            query = text("""
-                WITH 
-                input_polygon AS (
-                    SELECT ST_SetSRID(ST_GeomFromText(:wkt_polygon), 4326) AS geom
-                )
-                SELECT sum(population.p_cnt) as population
-                FROM population
-                JOIN input_polygon ON ST_Intersects(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))
-                WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-                "overlap_ratio": request.overlap_ratio,
-            })
-            data = result.fetchone()
-
-            if data:
-                return PopulationResponse(population=data.population or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    await check_vintage("population", request.vintage)
+    cost = await estimate_polygon_cost(request, "population")
+    async with admitted_session(cost, "population") as session:
+        # 使用 PostGIS 查詢範圍內的人口數 空間篩選直接比對原始geometry欄位才能使用空間索引
+        query = text("""
+            WITH 
+            input_polygon AS (
+                SELECT ST_SetSRID(ST_GeomFromText(:wkt_polygon), 4326) AS geom
+            )
+            SELECT sum(population.p_cnt) as population
+            FROM population
+            JOIN input_polygon ON ST_Intersects(population.geometry, input_polygon.geom)
+            WHERE population.vintage = :vintage
+            AND (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "wkt_polygon": request.wkt_polygon,
+            "overlap_ratio": request.overlap_ratio,
+        })
+        data = result.fetchone()
+
+        if data:
+            return PopulationResponse(population=data.population or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
 
 
 # 計算多點面積範圍內面積
 @app.post("/area/polygon", response_model=AreaResponse)
 async def get_area_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""
-                SELECT ST_Area(
-                    ST_Transform(
-                        ST_GeomFromText(
-                            :wkt_polygon, 
-                            4326
-                        ), 
-                        32651
-                    )
-                ) AS area;
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-            })
-            data = result.fetchone()
-
-            if data:
-                return AreaResponse(area=data.area or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    cost = await estimate_polygon_cost(request)
+    async with admitted_session(cost) as session:
+        # 使用 PostGIS 查詢範圍內的戶數
+        query = text("""
+            SELECT ST_Area(
+                ST_Transform(
+                    ST_GeomFromText(
+                        :wkt_polygon, 
+                        4326
+                    ), 
+                    32651
+                )
+            ) AS area;
+        """)
+        result = await session.execute(query, {
+            "wkt_polygon": request.wkt_polygon,
+        })
+        data = result.fetchone()
+
+        if data:
+            return AreaResponse(area=data.area or 0)
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
         
 
+# 查詢距離指定點最近的N筆門牌
+@app.post("/households/nearest", response_model=NearestHouseholdsResponse)
+async def get_nearest_households(request: NearestRequest):
+    await check_vintage("households", request.vintage)
+    cost = QueryCost(area=0, vertices=1, rows=request.limit)
+    async with admitted_session(cost, "households") as session:
+        # 使用 geography 索引依距離排序(<->) 單次索引掃描取得最近的N筆
+        query = text("""
+            SELECT city_code, dist_code, village, neighborhood, road_street, area, lane, alley, number,
+                   ST_X(geometry) AS longitude, ST_Y(geometry) AS latitude,
+                   geography(geometry) <-> geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)) AS distance
+            FROM households
+            WHERE vintage = :vintage
+            ORDER BY geography(geometry) <-> geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326))
+            LIMIT :limit;
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "longitude": request.longitude,
+            "latitude": request.latitude,
+            "limit": request.limit,
+        })
+
+        households = [NearestHousehold(**row._mapping) for row in result]
+        return NearestHouseholdsResponse(households=households)
+
+
+# 查詢距離指定點最近的N個有人口統計區
+@app.post("/population/nearest", response_model=NearestPopulationResponse)
+async def get_nearest_population(request: NearestRequest):
+    await check_vintage("population", request.vintage)
+    cost = QueryCost(area=0, vertices=1, rows=request.limit)
+    async with admitted_session(cost, "population") as session:
+        # 使用 geography 索引依距離排序(<->) 單次索引掃描取得最近的N個統計區
+        query = text("""
+            SELECT p_cnt AS population, properties,
+                   geography(geometry) <-> geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)) AS distance
+            FROM population
+            WHERE vintage = :vintage
+              AND p_cnt > 0
+            ORDER BY geography(geometry) <-> geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326))
+            LIMIT :limit;
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "longitude": request.longitude,
+            "latitude": request.latitude,
+            "limit": request.limit,
+        })
+
+        blocks = [
+            NearestBlock(
+                population=row.population,
+                properties=json.loads(row.properties) if isinstance(row.properties, str) else row.properties or {},
+                distance=row.distance,
+            )
+            for row in result
+        ]
+        return NearestPopulationResponse(blocks=blocks)
+
+
+# 取得範圍框內的家戶與人口密度網格
+@app.post("/density/grid", response_model=GridResponse)
+async def get_density_grid(request: GridRequest):
+    await check_vintage("density_grid", request.vintage)
+    if request.resolution not in DENSITY_GRID_RESOLUTIONS:
+        raise HTTPException(status_code=422, detail=f"resolution must be one of {DENSITY_GRID_RESOLUTIONS}")
+
+    cost = estimate_grid_cost(request)
+    async with admitted_session(cost, "density_grid") as session:
+        # 使用 PostGIS 查詢範圍框內的網格
+        query = text("""
+            SELECT ST_AsGeoJSON(geometry) AS geometry, households, population, area
+            FROM density_grid
+            WHERE vintage = :vintage
+              AND resolution = :resolution
+              AND geometry && ST_MakeEnvelope(:min_longitude, :min_latitude, :max_longitude, :max_latitude, 4326);
+        """)
+        result = await session.execute(query, {
+            "vintage": request.vintage,
+            "resolution": request.resolution,
+            "min_longitude": request.min_longitude,
+            "min_latitude": request.min_latitude,
+            "max_longitude": request.max_longitude,
+            "max_latitude": request.max_latitude,
+        })
+
+        features = [
+            {
+                "type": "Feature",
+                "geometry": json.loads(row.geometry),
+                "properties": {
+                    "households": row.households,
+                    "population": row.population,
+                    "households_density": row.households / row.area * 1e6,
+                    "population_density": row.population / row.area * 1e6,
+                },
+            }
+            for row in result
+        ]
+        return GridResponse(features=features)
+
+
 # 主程式
 if __name__ == "__main__":
     uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=True)
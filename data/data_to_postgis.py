@@ -1,10 +1,100 @@
 # 將外部公開資料傳入PostGis
 import pandas as pd
 from pyproj import Transformer
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
 import geopandas as gpd
+import pyarrow.parquet as pq
 from shapely.geometry import Point
+import json
 import os
+import sys
+import tempfile
+import time
+
+
+# 預設匯入的資料年度(民國年) 與API共用同一個環境變數
+DEFAULT_VINTAGE = int(os.getenv("DEFAULT_VINTAGE", 112))
+
+# 舊版未分區資料表固定匯入的資料年度 轉為分區時歸入此年度
+LEGACY_VINTAGE = 112
+
+# 替換分區時等待主資料表鎖定的上限 逾時則放棄本次替換稍後重試 避免長時間查詢期間API查詢排在替換之後
+SWAP_LOCK_TIMEOUT = os.getenv("SWAP_LOCK_TIMEOUT", "1s")
+SWAP_RETRIES = int(os.getenv("SWAP_RETRIES", 60))  # 重試次數
+SWAP_RETRY_DELAY = float(os.getenv("SWAP_RETRY_DELAY", 1))  # 重試間隔(秒)
+
+# 本機GeoParquet快照存放目錄與每個row group的筆數
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_ROW_GROUP_SIZE = int(os.getenv("SNAPSHOT_ROW_GROUP_SIZE", 20000))
+SNAPSHOT_VERSION_KEY = 'snapshot_version'  # 資料庫版本戳記 以DataFrame.attrs寫入parquet的key-value metadata(PANDAS_ATTRS)
+
+# 密度網格解析度(六角形邊長 單位為公尺) 由細到粗供不同地圖縮放層級使用
+DENSITY_GRID_RESOLUTIONS = [250, 500, 1000, 2000, 4000]
+
+# 依資料年度(vintage)分區的資料表欄位定義
+PARTITIONED_TABLES = {
+    'households': """
+        vintage integer NOT NULL,
+        city_code text,
+        dist_code text,
+        village text,
+        neighborhood text,
+        road_street text,
+        area text,
+        lane text,
+        alley text,
+        number text,
+        geometry geometry(Point, 4326) NOT NULL
+    """,
+    'population': """
+        vintage integer NOT NULL,
+        p_cnt integer,
+        properties jsonb,
+        geometry geometry(Geometry, 4326) NOT NULL
+    """,
+    'density_grid': """
+        vintage integer NOT NULL,
+        resolution integer NOT NULL,
+        households integer NOT NULL,
+        population integer NOT NULL,
+        area double precision NOT NULL,
+        geometry geometry(Polygon, 4326) NOT NULL
+    """,
+}
+
+# 各分區資料表的索引定義 建在主資料表上 載入用資料表也建立相同索引 掛載分區時可直接沿用
+PARTITIONED_TABLE_INDEXES = {
+    'households': {
+        'geometry': 'USING GIST (geometry)',
+        'geography': 'USING GIST (geography(geometry))',  # 供以公尺為單位的半徑與最近鄰查詢使用
+    },
+    'population': {
+        'geometry': 'USING GIST (geometry)',
+        'geography': 'USING GIST (geography(geometry))',
+    },
+    'density_grid': {
+        'geometry': 'USING GIST (geometry)',
+        'resolution': '(resolution)',
+    },
+}
+
+# 將來源資料表(匯入暫存表或舊版未分區資料表)轉為分區欄位格式的查詢
+PARTITION_SELECTS = {
+    'households': """
+        SELECT :vintage, city_code::text, dist_code::text, village::text, neighborhood::text,
+               road_street::text, area::text, lane::text, alley::text, number::text, geometry
+        FROM {source}
+    """,
+    'population': """
+        SELECT :vintage, source.p_cnt::integer, to_jsonb(source) - 'geometry' - 'p_cnt', source.geometry
+        FROM {source} AS source
+    """,
+    'density_grid': """
+        SELECT :vintage, resolution, households, population, area, geometry
+        FROM {source}
+    """,
+}
 
 
 # 建立資料庫引擎函數
@@ -23,11 +113,149 @@ def CreateSQLEngine():
     return engine
 
 
+# 建立依年度分區的主資料表函數
+def PreparePartitionedTable(conn, tableName):
+
+    # 記錄各資料表已匯入的年度與匯入時間 供API檢查年度是否存在
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS dataset_vintages (
+            table_name text NOT NULL,
+            vintage integer NOT NULL,
+            loaded_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name, vintage)
+        );
+    """))
+
+    # 舊版未分區的資料表改名保留 建立主資料表後將其資料轉入舊版年度分區
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {"table": tableName},
+    ).scalar()
+    legacyName = f'{tableName}_legacy'
+    if relkind is not None and relkind != 'p':
+        conn.execute(text(f"ALTER TABLE {tableName} RENAME TO {legacyName};"))
+        print(f"Renamed unpartitioned table {tableName} to {legacyName}, migrating it as vintage {LEGACY_VINTAGE}")
+
+    # 建立依年度分區的主資料表 索引建在主資料表上會自動套用至各分區
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {tableName} ({PARTITIONED_TABLES[tableName]}) PARTITION BY LIST (vintage);"))
+    for indexName, definition in PARTITIONED_TABLE_INDEXES[tableName].items():
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {tableName}_{indexName}_idx ON {tableName} {definition};"))
+
+    # 舊資料表存在但舊版年度尚未記錄為已匯入(包含上次轉入中途失敗) 需要轉入
+    pending = conn.execute(text("""
+        SELECT to_regclass(:legacy) IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM dataset_vintages WHERE table_name = :table AND vintage = :vintage)
+    """), {"legacy": legacyName, "table": tableName, "vintage": LEGACY_VINTAGE}).scalar()
+
+    return legacyName if pending else None
+
+
+# 建立指定年度的載入用資料表函數 與主資料表欄位相同但尚未掛載 載入期間不會鎖定主資料表
+def CreateLoadTable(conn, tableName, vintage):
+
+    loadName = f'{tableName}_{int(vintage)}_load'
+    conn.execute(text(f"""
+        DROP TABLE IF EXISTS {loadName};
+        CREATE TABLE {loadName} (LIKE {tableName} INCLUDING DEFAULTS);
+        ALTER TABLE {loadName} ADD CONSTRAINT {loadName}_vintage_check CHECK (vintage = {int(vintage)});
+    """))
+
+    return loadName
+
+
+# 將載入完成的資料表掛載為該年度分區函數 舊分區先卸載 再於另一個交易中移除
+# 卸載分區需要主資料表的獨佔鎖 等待鎖定期間新的查詢會排在後面 因此限制等待時間 逾時則稍後重試
+def AttachVintagePartition(engine, tableName, vintage, loadName):
+
+    partitionName = f'{tableName}_{int(vintage)}'
+    retiredName = f'{tableName}_{int(vintage)}_retired'
+
+    # 於掛載前建立索引與統計資料 掛載時沿用不需重建
+    with engine.begin() as conn:
+        for definition in PARTITIONED_TABLE_INDEXES[tableName].values():
+            conn.execute(text(f"CREATE INDEX ON {loadName} {definition};"))
+        conn.execute(text(f"ANALYZE {loadName};"))
+
+    # 短交易內替換分區 並記錄匯入時間
+    for attempt in range(1, SWAP_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("SELECT set_config('lock_timeout', :timeout, true);"), {"timeout": SWAP_LOCK_TIMEOUT})
+                exists = conn.execute(text("SELECT to_regclass(:partition) IS NOT NULL"), {"partition": partitionName}).scalar()
+                if exists:
+                    conn.execute(text(f"""
+                        DROP TABLE IF EXISTS {retiredName};
+                        ALTER TABLE {tableName} DETACH PARTITION {partitionName};
+                        ALTER TABLE {partitionName} RENAME TO {retiredName};
+                    """))
+                conn.execute(text(f"""
+                    ALTER TABLE {loadName} RENAME TO {partitionName};
+                    ALTER TABLE {tableName} ATTACH PARTITION {partitionName} FOR VALUES IN ({int(vintage)});
+                """))
+                conn.execute(text("""
+                    INSERT INTO dataset_vintages (table_name, vintage, loaded_at)
+                    VALUES (:table, :vintage, now())
+                    ON CONFLICT (table_name, vintage) DO UPDATE SET loaded_at = excluded.loaded_at;
+                """), {"table": tableName, "vintage": vintage})
+            break
+        except DBAPIError as e:
+            # 55P03: 等待鎖定逾時 交易已回復 稍後重試
+            if getattr(e.orig, 'pgcode', None) != '55P03' or attempt == SWAP_RETRIES:
+                raise
+            print(f"{tableName} is busy, retrying the vintage {vintage} partition swap in {SWAP_RETRY_DELAY}s ({attempt}/{SWAP_RETRIES})")
+            time.sleep(SWAP_RETRY_DELAY)
+
+    # 移除舊分區
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {retiredName};"))
+
+    return partitionName
+
+
+# 將來源資料表內容轉入指定年度分區函數
+def LoadFromSource(engine, tableName, vintage, sourceName):
+
+    with engine.begin() as conn:
+        loadName = CreateLoadTable(conn, tableName, vintage)
+        selectSQL = PARTITION_SELECTS[tableName].format(source=sourceName)
+        conn.execute(text(f"INSERT INTO {loadName} {selectSQL};"), {"vintage": vintage})
+
+    return AttachVintagePartition(engine, tableName, vintage, loadName)
+
+
+# 建立主資料表並轉入舊版未分區資料函數
+def MigratePartitionedTable(engine, tableName):
+
+    with engine.begin() as conn:
+        legacyName = PreparePartitionedTable(conn, tableName)
+
+    # 舊資料轉入後保留舊資料表 確認無誤後可自行移除
+    if legacyName is not None:
+        LoadFromSource(engine, tableName, LEGACY_VINTAGE, legacyName)
+        print(f"Migrated {legacyName} into {tableName} vintage {LEGACY_VINTAGE}; drop {legacyName} once verified")
+
+
+# 將資料匯入指定年度分區函數
+def LoadVintagePartition(engine, tableName, vintage, data):
+
+    MigratePartitionedTable(engine, tableName)
+
+    # 先匯入暫存資料表 再轉換欄位型別寫入分區
+    stagingName = f'{tableName}_{int(vintage)}_staging'
+    data.to_postgis(stagingName, con=engine, if_exists='replace')
+    partitionName = LoadFromSource(engine, tableName, vintage, stagingName)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE {stagingName};"))
+
+    return partitionName
+
+
 # 整理臺南市門牌座標資料函數
-def ImportHouseholdsData(engine):
+def ImportHouseholdsData(engine, vintage=DEFAULT_VINTAGE):
 
     # 讀取門牌座標資料
-    householdsData = pd.read_csv('112年臺南市門牌坐標資料.csv')
+    householdsData = pd.read_csv(f'{vintage}年臺南市門牌坐標資料.csv')
 
     # 建立經緯度轉換器
     transformer = Transformer.from_crs("EPSG:3826", "EPSG:4326", always_xy=True)
@@ -54,46 +282,200 @@ def ImportHouseholdsData(engine):
     # 設定座標系統
     householdsData.crs = 'EPSG:4326'
 
-    # 匯入資料至資料庫
-    householdsData.to_postgis('households', con=engine, if_exists='replace')
+    # 匯入資料至資料庫該年度分區
+    LoadVintagePartition(engine, 'households', vintage, householdsData)
 
     return householdsData
 
 
 # 匯入臺南市人口統計資料函數
-def ImportPopulationData(engine):
+def ImportPopulationData(engine, vintage=DEFAULT_VINTAGE):
 
     # 讀取Geojson檔案
-    fileName = '112年12月臺南市統計區人口統計_最小統計區_WGS84.geojson'
+    fileName = f'{vintage}年12月臺南市統計區人口統計_最小統計區_WGS84.geojson'
     populationData = gpd.read_file(fileName)
     populationData.columns = populationData.columns.str.lower()
 
-    # 匯入資料至資料庫
-    populationData.to_postgis('population', con=engine, if_exists='replace')
-    
+    # 匯入資料至資料庫該年度分區 各年度不一致的其餘欄位保存於properties
+    LoadVintagePartition(engine, 'population', vintage, populationData)
+
     return populationData
 
 
-# 自PostGIS資料庫讀取資料
-def GetPostGISData(engine, tableName):
-    gdf = gpd.read_postgis(tableName, con=engine, geom_col='geometry')
+# 建立多解析度家戶與人口密度網格函數
+def BuildDensityGrid(engine, vintage=DEFAULT_VINTAGE, resolutions=DENSITY_GRID_RESOLUTIONS):
+
+    MigratePartitionedTable(engine, 'density_grid')
+
+    with engine.begin() as conn:
+
+        # 於載入用資料表建立該年度密度網格 完成後再掛載為分區
+        loadName = CreateLoadTable(conn, 'density_grid', vintage)
+
+        # 以TWD97(EPSG:3826)公尺座標切六角形網格 家戶以門牌點位計數 人口以統計區內部點歸屬網格
+        query = text(f"""
+            INSERT INTO {loadName} (vintage, resolution, households, population, area, geometry)
+            WITH
+            bounds AS (
+                SELECT ST_Transform(ST_SetSRID(ST_Extent(geometry)::geometry, 4326), 3826) AS geom
+                FROM population
+                WHERE vintage = :vintage
+            ),
+            grid AS (
+                SELECT ST_Area(hex.geom) AS area, ST_Transform(hex.geom, 4326) AS geom
+                FROM bounds, ST_HexagonGrid(:resolution, bounds.geom) AS hex
+            ),
+            cells AS (
+                SELECT
+                    grid.area,
+                    grid.geom,
+                    (
+                        SELECT count(*)
+                        FROM households
+                        WHERE households.vintage = :vintage
+                          AND ST_Intersects(households.geometry, grid.geom)
+                    ) AS households,
+                    (
+                        SELECT coalesce(sum(population.p_cnt), 0)
+                        FROM population
+                        WHERE population.vintage = :vintage
+                          AND population.geometry && grid.geom
+                          AND ST_Intersects(ST_PointOnSurface(population.geometry), grid.geom)
+                    ) AS population
+                FROM grid
+            )
+            SELECT :vintage, :resolution, households, population, area, geom
+            FROM cells
+            WHERE households > 0 OR population > 0;
+        """)
+        for resolution in resolutions:
+            conn.execute(query, {"vintage": vintage, "resolution": resolution})
+
+    return AttachVintagePartition(engine, 'density_grid', vintage, loadName)
+
+
+# 本機快照檔案路徑函數
+def SnapshotPath(tableName, vintage, snapshotDir=SNAPSHOT_DIR):
+    return os.path.join(snapshotDir, f'{tableName}_{int(vintage)}.parquet')
+
+
+# 取得資料庫中該年度分區的版本戳記(匯入時間) 重新匯入同年度資料後會改變
+def GetSnapshotVersion(engine, tableName, vintage):
+    with engine.connect() as conn:
+        loadedAt = conn.execute(
+            text("SELECT loaded_at FROM dataset_vintages WHERE table_name = :table AND vintage = :vintage"),
+            {"table": tableName, "vintage": vintage},
+        ).scalar()
+    if loadedAt is None:
+        raise ValueError(f"No {tableName} data loaded for vintage {vintage}")
+    return loadedAt.isoformat()
+
+
+# 讀取本機快照記錄的版本戳記 快照不存在或沒有戳記時回傳None
+def ReadSnapshotVersion(path):
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    attrs = json.loads(metadata.get(b'PANDAS_ATTRS', b'{}'))
+    return attrs.get(SNAPSHOT_VERSION_KEY)
+
+
+# 將資料表指定年度匯出為GeoParquet快照函數 版本戳記寫入parquet的key-value metadata
+def ExportSnapshot(engine, tableName, vintage, snapshotDir=SNAPSHOT_DIR):
+
+    # 先取得版本戳記再讀取資料 匯出期間若重新匯入 下次讀取時戳記不符會再重新匯出
+    version = GetSnapshotVersion(engine, tableName, vintage)
+    gdf = GetPostGISData(engine, tableName, vintage)
+
+    # jsonb欄位以JSON字串保存 避免各年度屬性不同造成欄位型別不一致
+    if 'properties' in gdf.columns:
+        gdf['properties'] = gdf['properties'].map(json.dumps)
+
+    # 依Hilbert曲線排序 讓每個row group涵蓋相近的空間範圍 範圍框篩選時可依統計值略過整個row group
+    gdf = gdf.iloc[gdf.geometry.hilbert_distance().argsort()]
+    gdf.attrs[SNAPSHOT_VERSION_KEY] = version
+
+    # 寫入不重複的暫存檔後再取代 避免讀取到寫入中的快照 同時匯出時也不會互相覆寫
+    os.makedirs(snapshotDir, exist_ok=True)
+    path = SnapshotPath(tableName, vintage, snapshotDir)
+    fd, tmpPath = tempfile.mkstemp(dir=snapshotDir, prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        gdf.to_parquet(tmpPath, index=False, write_covering_bbox=True, row_group_size=SNAPSHOT_ROW_GROUP_SIZE)
+        os.replace(tmpPath, path)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+    return path
+
+
+# 讀取本機GeoParquet快照函數 快照不存在或版本戳記與資料庫不符時自資料庫重新匯出
+def ReadSnapshot(engine, tableName, vintage, columns=None, bbox=None, snapshotDir=SNAPSHOT_DIR):
+
+    path = SnapshotPath(tableName, vintage, snapshotDir)
+    if ReadSnapshotVersion(path) != GetSnapshotVersion(engine, tableName, vintage):
+        ExportSnapshot(engine, tableName, vintage, snapshotDir)
+
+    # 只讀取需要的欄位 範圍框(xmin, ymin, xmax, ymax)篩選使用row group統計值 並以記憶體映射讀檔
+    readColumns = list(dict.fromkeys([*columns, 'geometry'])) if columns else None
+    gdf = gpd.read_parquet(path, columns=readColumns, bbox=bbox, memory_map=True)
+    gdf = gdf.drop(columns='bbox', errors='ignore')
+
+    if 'properties' in gdf.columns:
+        gdf['properties'] = gdf['properties'].map(json.loads)
+
+    return gdf
+
+
+# 自PostGIS資料庫讀取資料函數
+# vintage: 只讀取該年度分區 columns: 只讀取指定欄位 bbox: 只讀取與範圍框(xmin, ymin, xmax, ymax)相交的資料
+# useSnapshot: 改讀本機GeoParquet快照 避免離線分析反覆查詢正式資料庫 快照以年度為單位 需指定vintage
+def GetPostGISData(engine, tableName, vintage=None, columns=None, bbox=None, useSnapshot=False):
+
+    if useSnapshot:
+        if vintage is None:
+            raise ValueError("vintage is required when useSnapshot=True")
+        return ReadSnapshot(engine, tableName, vintage, columns, bbox)
+
+    conditions = []
+    params = {}
+    if vintage is not None:
+        conditions.append('vintage = %(vintage)s')
+        params['vintage'] = vintage
+    if bbox is not None:
+        conditions.append('geometry && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)')
+        params.update(zip(['xmin', 'ymin', 'xmax', 'ymax'], bbox))
+
+    selectColumns = ', '.join(dict.fromkeys([*columns, 'geometry'])) if columns else '*'
+    sql = f'SELECT {selectColumns} FROM {tableName}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+
+    gdf = gpd.read_postgis(sql, con=engine, geom_col='geometry', params=params)
     return gdf
 
 
 # 主程式
 if __name__ == '__main__':
 
+    # 匯入的資料年度 可由執行參數指定 例如: python data_to_postgis.py 113
+    vintage = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_VINTAGE
+
     # 建立資料庫引擎
     engine = CreateSQLEngine()
 
     # 整理臺南市門牌座標資料
-    ImportHouseholdsData(engine)
+    ImportHouseholdsData(engine, vintage)
 
     # 整理臺南市人口統計資料
-    ImportPopulationData(engine)
+    ImportPopulationData(engine, vintage)
+
+    # 建立多解析度家戶與人口密度網格
+    BuildDensityGrid(engine, vintage)
 
     # 自PostGIS資料庫讀取臺南市門牌座標資料
-    householdsData = GetPostGISData(engine, 'households')
+    householdsData = GetPostGISData(engine, 'households', vintage)
 
     # 自PostGIS資料庫讀取臺南市人口統計資料
-    populationData = GetPostGISData(engine, 'population')
\ No newline at end of file
+    populationData = GetPostGISData(engine, 'population', vintage)
@@ -0,0 +1,187 @@
+# 查詢計畫回歸檢查: 以合成資料呼叫各API 確認households與population查詢皆使用空間索引 且預估成本未超過基準值
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+
+import httpx
+from sqlalchemy import event, text
+
+import app as api
+import data_to_postgis as loader
+
+
+# 合成資料範圍(臺南市範圍框 WGS84)
+SYNTHETIC_BOUNDS = (120.02, 22.88, 120.66, 23.42)
+
+# 合成資料規模 需足夠大 規劃器才會在有索引時選擇索引掃描
+SYNTHETIC_HOUSEHOLDS = int(os.getenv("PLANCHECK_HOUSEHOLDS", 200000))
+SYNTHETIC_BLOCK_SIZE = int(os.getenv("PLANCHECK_BLOCK_SIZE", 400))  # 合成統計區邊長(公尺)
+
+# 預估成本基準檔案
+BASELINE_FILE = os.getenv("PLAN_BASELINE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_baseline.json"))
+
+# 需要檢查的查詢與不得出現循序掃描的資料表(含各年度分區)
+CHECKED_QUERY = re.compile(r"\b(households|population)\b")
+INDEXED_RELATION = re.compile(r"^(households|population)(_\d+)?$")
+
+# 檢查案例: 每個會查詢資料表的API各一筆
+CHECK_CASES = [
+    ("/households/point", {"longitude": 120.1854, "latitude": 22.9921, "radius": 500}),
+    ("/population/point", {"longitude": 120.1854, "latitude": 22.9921, "radius": 500, "overlap_ratio": 0.5}),
+    ("/households/polygon", {"wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))"}),
+    ("/population/polygon", {"wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))", "overlap_ratio": 0.5}),
+    ("/households/nearest", {"longitude": 120.1854, "latitude": 22.9921, "limit": 1000}),
+    ("/population/nearest", {"longitude": 120.1854, "latitude": 22.9921, "limit": 100}),
+    ("/density/grid", {"min_longitude": 120.15, "min_latitude": 22.95, "max_longitude": 120.25, "max_latitude": 23.05, "resolution": 500}),
+]
+
+
+# 匯入合成資料函數 沿用資料匯入程式的分區結構與密度網格
+def LoadSyntheticData(engine, vintage):
+
+    xmin, ymin, xmax, ymax = SYNTHETIC_BOUNDS
+
+    with engine.begin() as conn:
+
+        # 固定亂數種子 讓每次產生的資料與預估成本一致
+        conn.execute(text("SELECT setseed(0.42);"))
+
+        # 隨機分布的門牌點位
+        loader.PreparePartitionedTable(conn, 'households')
+        householdsLoad = loader.CreateLoadTable(conn, 'households', vintage)
+        conn.execute(text(f"""
+            INSERT INTO {householdsLoad} (vintage, city_code, dist_code, village, neighborhood, road_street, area, lane, alley, number, geometry)
+            SELECT :vintage, '67000', (67000010 + i % 37 * 100)::text, '村里' || (i % 700), (i % 30)::text,
+                   '街路' || (i % 2000), NULL, (i % 200)::text, NULL, (i % 500)::text,
+                   ST_SetSRID(ST_Point(:xmin + random() * (:xmax - :xmin), :ymin + random() * (:ymax - :ymin)), 4326)
+            FROM generate_series(1, :households) AS i;
+        """), {"vintage": vintage, "households": SYNTHETIC_HOUSEHOLDS, "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax})
+
+        # 以TWD97方格切出的統計區
+        loader.PreparePartitionedTable(conn, 'population')
+        populationLoad = loader.CreateLoadTable(conn, 'population', vintage)
+        conn.execute(text(f"""
+            INSERT INTO {populationLoad} (vintage, p_cnt, properties, geometry)
+            SELECT :vintage, (random() * 300)::integer, jsonb_build_object('codebase', 'S' || cell.i || '_' || cell.j),
+                   ST_Transform(cell.geom, 4326)
+            FROM ST_SquareGrid(:block_size, ST_Transform(ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326), 3826)) AS cell;
+        """), {"vintage": vintage, "block_size": SYNTHETIC_BLOCK_SIZE, "xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax})
+
+    loader.AttachVintagePartition(engine, 'households', vintage, householdsLoad)
+    loader.AttachVintagePartition(engine, 'population', vintage, populationLoad)
+    loader.BuildDensityGrid(engine, vintage)
+
+
+# 逐層走訪查詢計畫 找出對households/population的循序掃描
+def FindSeqScans(node):
+    scans = []
+    if node.get("Node Type") == "Seq Scan" and INDEXED_RELATION.match(node.get("Relation Name", "")):
+        scans.append(node["Relation Name"])
+    for child in node.get("Plans", []):
+        scans.extend(FindSeqScans(child))
+    return scans
+
+
+# 呼叫各API 並在每個查詢資料表的SQL執行前以相同參數取得其查詢計畫
+async def CollectPlans():
+
+    plans = {}
+    current = {}
+
+    @event.listens_for(api.engine.sync_engine, "before_cursor_execute")
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("EXPLAIN") or not CHECKED_QUERY.search(statement):
+            return
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        plans.setdefault(current["path"], []).append(json.loads(plan) if isinstance(plan, str) else plan)
+
+    errors = []
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://plancheck") as client:
+        for path, payload in CHECK_CASES:
+            current["path"] = path
+            response = await client.post(path, json=payload)
+            if response.status_code != 200:
+                errors.append(f"{path}: HTTP {response.status_code} {response.text}")
+
+    await api.engine.dispose()
+    return plans, errors
+
+
+# 檢查查詢計畫並與基準值比較 未記錄基準值的查詢視為失敗(重新記錄基準值時除外)
+def CheckPlans(plans, baseline, tolerance, updateBaseline=False):
+
+    failures = []
+    costs = {}
+    for path, _ in CHECK_CASES:
+        if path not in plans:
+            failures.append(f"{path}: no households/population query was executed")
+            continue
+
+        for n, plan in enumerate(plans[path]):
+            key = path if n == 0 else f"{path}#{n}"
+            root = plan[0]["Plan"]
+            costs[key] = root["Total Cost"]
+
+            for relation in FindSeqScans(root):
+                failures.append(f"{key}: sequential scan on {relation}")
+
+            if key not in baseline:
+                if updateBaseline:
+                    print(f"{key}: cost {costs[key]:.1f} (new baseline)")
+                else:
+                    failures.append(f"{key}: no baseline recorded in {BASELINE_FILE}; run with --update-baseline to record it")
+            elif costs[key] > baseline[key] * (1 + tolerance):
+                failures.append(f"{key}: estimated cost {costs[key]:.1f} exceeds baseline {baseline[key]:.1f} by more than {tolerance:.0%}")
+            else:
+                print(f"{key}: cost {costs[key]:.1f} (baseline {baseline[key]:.1f})")
+
+    return failures, costs
+
+
+# 主程式
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Check that API queries keep using spatial indexes on households/population")
+    parser.add_argument("--update-baseline", action="store_true", help="record the current estimated costs as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative cost increase over the baseline (default: 0.2)")
+    parser.add_argument("--skip-load", action="store_true", help="reuse synthetic data already loaded into the database")
+    args = parser.parse_args()
+
+    # 關閉API的SQL輸出 避免干擾檢查結果
+    api.engine.sync_engine.echo = False
+
+    # 匯入合成資料
+    if not args.skip_load:
+        LoadSyntheticData(loader.CreateSQLEngine(), api.DEFAULT_VINTAGE)
+
+    # 取得各API查詢計畫
+    plans, errors = asyncio.run(CollectPlans())
+
+    # 讀取預估成本基準值 基準值檔案不存在時(重新記錄基準值除外)視為失敗
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding="utf-8") as f:
+            baseline = json.load(f)
+    elif not args.update_baseline:
+        errors.append(f"baseline file {BASELINE_FILE} not found; record it once with --update-baseline and commit it")
+
+    failures, costs = CheckPlans(plans, baseline, args.tolerance, args.update_baseline)
+    failures = errors + failures
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(costs, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {BASELINE_FILE}")
+
+    if failures:
+        print("\nQuery plan check failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+
+    print("\nQuery plan check passed")
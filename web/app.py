@@ -25,6 +25,45 @@ app = dash.Dash(
 )
 server = app.server
 
+# 密度網格著色方式: 依數值所在區間填入對應顏色
+density_style = assign("""function(feature, context){
+    const {classes, colorscale, style, colorProp} = context.hideout;
+    const value = feature.properties[colorProp];
+    style.fillColor = colorscale[0];
+    for (let i = 0; i < classes.length; ++i) {
+        if (value > classes[i]) {
+            style.fillColor = colorscale[i];
+        }
+    }
+    return style;
+}""")
+
+# 密度熱度圖色階與分級(每平方公里)
+density_colorscale = ['#FFEDA0', '#FED976', '#FEB24C', '#FD8D3C', '#FC4E2A', '#E31A1C', '#BD0026', '#800026']
+density_style_base = dict(weight=0, fillOpacity=0.6)
+households_density_hideout = dict(
+    colorscale=density_colorscale,
+    classes=[0, 50, 200, 500, 1000, 2000, 5000, 10000],
+    style=density_style_base,
+    colorProp='households_density',
+)
+population_density_hideout = dict(
+    colorscale=density_colorscale,
+    classes=[0, 100, 500, 1000, 2000, 5000, 10000, 20000],
+    style=density_style_base,
+    colorProp='population_density',
+)
+
+# 地圖縮放層級對應的密度網格解析度(公尺) 越放大使用越細的網格
+density_grid_zoom_resolutions = [(15, 250), (14, 500), (13, 1000), (12, 2000)]
+density_grid_default_resolution = 4000
+
+# 地圖尚未回報可視範圍時使用的臺南市範圍框 [[南, 西], [北, 東]]
+tainan_bounds = [[22.88, 120.02], [23.42, 120.66]]
+
+# 呼叫API的逾時秒數
+api_timeout = 10
+
 app.layout = dbc.Container([
 
     dbc.Row([
@@ -76,6 +115,17 @@ app.layout = dbc.Container([
                 zoom=11,
                 children=[
                     dl.TileLayer(),  # 基礎地圖
+                    # 家戶與人口密度熱度圖(可於右上角切換顯示)
+                    dl.LayersControl(id="density-layers", children=[
+                        dl.Overlay(
+                            dl.GeoJSON(id="households-density", style=density_style, hideout=households_density_hideout),
+                            name="家戶密度", checked=False,
+                        ),
+                        dl.Overlay(
+                            dl.GeoJSON(id="population-density", style=density_style, hideout=population_density_hideout),
+                            name="人口密度", checked=False,
+                        ),
+                    ]),
                     dl.FeatureGroup([
                         # 開啟地圖編輯控制
                         dl.EditControl(
@@ -233,6 +283,50 @@ def generate_inputs(field_name, field_type):
     return outputs
 
 
+# 依地圖可視範圍與縮放層級載入密度網格
+@app.callback(
+    Output("households-density", "data"),
+    Output("population-density", "data"),
+    Input("map", "bounds"),
+    Input("map", "zoom"),
+    Input("density-layers", "overlays"),
+)
+def load_density_grid(bounds, zoom, overlays):
+
+    # 熱度圖皆未開啟時不呼叫API 並清除已隱藏圖層的資料
+    overlays = overlays or []
+    show_households = "家戶密度" in overlays
+    show_population = "人口密度" in overlays
+    if not show_households and not show_population:
+        return None, None
+
+    # 依縮放層級選擇網格解析度
+    resolution = density_grid_default_resolution
+    for min_zoom, zoom_resolution in density_grid_zoom_resolutions:
+        if zoom is not None and zoom >= min_zoom:
+            resolution = zoom_resolution
+            break
+
+    (south, west), (north, east) = bounds or tainan_bounds
+    url = f'http://{api_server}:{api_port}/density/grid'
+    data = {
+        'min_longitude': west,
+        'min_latitude': south,
+        'max_longitude': east,
+        'max_latitude': north,
+        'resolution': resolution,
+    }
+    try:
+        response = requests.post(url, json=data, timeout=api_timeout)
+    except requests.RequestException:
+        return dash.no_update, dash.no_update
+    if response.status_code != 200:
+        return dash.no_update, dash.no_update
+
+    grid = response.json()
+    return (grid if show_households else None), (grid if show_population else None)
+
+
 # 處理使用者地圖標記多邊形
 @app.callback(
         Output("geojson", "data"), 